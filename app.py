@@ -1,56 +1,352 @@
+import asyncio
 import os
+import re
+import secrets
+import struct
 import tempfile
+from collections import deque
+from contextlib import asynccontextmanager
+from functools import lru_cache
 from pathlib import Path
 from typing import Optional
 
 import numpy as np
 import soundfile as sf
 import torch
-from fastapi import FastAPI, HTTPException, BackgroundTasks
-from fastapi.responses import FileResponse, JSONResponse
-from pydantic import BaseModel
+from cached_path import cached_path
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+from pydantic import BaseModel, Field
 
 from f5_tts.infer.utils_infer import (
-    infer_process,
     load_model,
     load_vocoder,
     preprocess_ref_audio_text,
 )
 from f5_tts.model import DiT
 
+import sampler
+from sampler import MIN_CHUNK_BYTES, cross_fade, infer_batch, infer_process, load_reference
+
 
 # Configuration
 VOICES_DIR = os.getenv("VOICES_DIR", "data/voices")
 MODEL_NAME = os.getenv("MODEL_NAME", "F5-TTS")
 HOST = os.getenv("HOST", "0.0.0.0")
 PORT = int(os.getenv("PORT", "7861"))
+COMPILE_MODEL = os.getenv("COMPILE_MODEL", "1") == "1"
+CUDA_GRAPHS = os.getenv("CUDA_GRAPHS", "1") == "1"
+CUDA_GRAPH_CACHE_SIZE = int(os.getenv("CUDA_GRAPH_CACHE_SIZE", "0"))
+SEQ_LEN_BUCKET = int(os.getenv("SEQ_LEN_BUCKET", "64"))
+QUANTIZE_INT8 = os.getenv("QUANTIZE_INT8", "0") == "1"
+INFERENCE_QUEUE_SIZE = int(os.getenv("INFERENCE_QUEUE_SIZE", "8"))
+MAX_BATCH_SIZE = int(os.getenv("MAX_BATCH_SIZE", "4"))
+MAX_BATCH_DELAY_MS = float(os.getenv("MAX_BATCH_DELAY_MS", "10"))
+# How often a request waiting in the queue checks whether its client is still connected
+DISCONNECT_POLL_INTERVAL = 0.1
 
-# Initialize FastAPI app
-app = FastAPI(title="byov-tts-server", description="Voice cloning Server using F5-TTS")
+# Sentence boundaries used to stream long text; the punctuation stays with its sentence
+SENTENCE_BOUNDARY = re.compile(r"(?<=[.!?])\s+")
+# Streamed text is packed into a short first chunk so audio starts quickly, then larger ones
+STREAM_FIRST_CHUNK_BYTES = 60
+STREAM_CHUNK_BYTES = 200
 
 # Global model state
 vocoder = None
 ema_model = None
+inference_dtype = None
+inference_queue = None
+inference_worker_task = None
+voice_preload_task = None
+_voices_cache = {"mtime": None, "payload": None}
 
 
-@app.on_event("startup")
-async def startup_event():
-    """Load models on startup"""
-    global vocoder, ema_model
+@asynccontextmanager
+async def lifespan(app):
+    """Load and warm up models before serving; stop background tasks on shutdown"""
+    global vocoder, ema_model, inference_dtype, inference_queue, inference_worker_task, voice_preload_task
     
     print("Loading vocoder...")
     vocoder = load_vocoder()
     
     print("Loading F5-TTS model...")
     # Use the default F5-TTS model configuration
-    from cached_path import cached_path
-    import json
-    
     ckpt_path = str(cached_path("hf://SWivid/F5-TTS/F5TTS_v1_Base/model_1250000.safetensors"))
     model_cfg = dict(dim=1024, depth=22, heads=16, ff_mult=2, text_dim=512, conv_layers=4)
     ema_model = load_model(DiT, model_cfg, ckpt_path)
+    # The sampler calls the DiT directly rather than through CFM.sample, which would do this
+    ema_model.eval()
+    
+    if torch.cuda.is_available():
+        torch.backends.cuda.matmul.allow_tf32 = True
+        torch.backends.cudnn.allow_tf32 = True
+        torch.set_float32_matmul_precision("high")
+        # Sequence lengths differ on nearly every request, so per-shape algorithm search never pays off
+        torch.backends.cudnn.benchmark = False
+        
+        # Run the DiT in half precision; the mel front-end and vocoder stay in FP32
+        inference_dtype = torch.bfloat16 if torch.cuda.is_bf16_supported() else torch.float16
+        ema_model = ema_model.to(dtype=inference_dtype)
+        ema_model.mel_spec.float()
+        
+        # Bucketed lengths keep the number of compiled variants and CUDA graphs small
+        if SEQ_LEN_BUCKET > 0:
+            sampler.enable_shape_buckets(ema_model, SEQ_LEN_BUCKET)
+        if CUDA_GRAPHS:
+            # By default keep one graph for every bucketed batch shape
+            max_graphs = CUDA_GRAPH_CACHE_SIZE or sampler.graph_cache_size(MAX_BATCH_SIZE, SEQ_LEN_BUCKET)
+            sampler.enable_cuda_graphs(max_graphs)
+        sampler.enable_stream_overlap()
+        
+        if COMPILE_MODEL:
+            print("Compiling model...")
+            compile_kwargs = dict(mode="reduce-overhead", fullgraph=False, dynamic=True)
+            # The DiT step is captured into our own CUDA graphs, so inductor must not add its own
+            dit_compile_kwargs = dict(compile_kwargs, mode="default") if CUDA_GRAPHS else compile_kwargs
+            sampler.compile_dit(**dit_compile_kwargs)
+            # Vocoder input lengths vary with every request, so CUDA graphs would be
+            # recorded for nearly each one and never freed
+            vocoder.decode = torch.compile(vocoder.decode, **dict(compile_kwargs, mode="default"))
+        
+        # Pay cuBLAS/cuDNN init, allocator growth and compilation up front
+        print("Warming up...")
+        try:
+            warmup()
+        except Exception as e:
+            print(f"Warning: warmup failed, the first request will be slower: {e}")
+    
+    elif QUANTIZE_INT8 and next(ema_model.parameters()).device.type == "cpu":
+        # Dynamic int8 quantization of the DiT's linear layers for CPU-only deployments
+        print("Quantizing model to int8...")
+        ema_model = torch.ao.quantization.quantize_dynamic(ema_model, {torch.nn.Linear}, dtype=torch.qint8)
+    
+    # A single worker owns the GPU; requests beyond the queue size are rejected
+    inference_queue = asyncio.Queue(maxsize=INFERENCE_QUEUE_SIZE)
+    inference_worker_task = asyncio.create_task(inference_worker())
+    
+    # Preprocess every voice in the background so /health is served right away
+    voice_preload_task = asyncio.create_task(asyncio.to_thread(preload_voices))
     
     print("Models loaded successfully!")
+    
+    yield
+    
+    inference_worker_task.cancel()
+    voice_preload_task.cancel()
+
+
+# Initialize FastAPI app
+app = FastAPI(title="byov-tts-server", description="Voice cloning Server using F5-TTS", lifespan=lifespan)
+
+
+def warmup():
+    """Run a short throwaway generation on synthetic reference audio"""
+    with tempfile.NamedTemporaryFile(suffix=".wav", delete=False) as tmp_file:
+        warmup_audio_path = tmp_file.name
+        sf.write(warmup_audio_path, np.random.uniform(-0.1, 0.1, 2 * 24000).astype(np.float32), 24000)
+    
+    try:
+        with torch.inference_mode(), torch.autocast(
+            device_type="cuda", dtype=inference_dtype, enabled=inference_dtype is not None, cache_enabled=False
+        ):
+            infer_process(
+                warmup_audio_path, "Hello. ", "hello.", ema_model, vocoder, nfe_step=4, show_info=lambda *_: None
+            )
+    finally:
+        os.unlink(warmup_audio_path)
+
+
+@lru_cache(maxsize=64)
+def _cached_pre(path: str, mtime: float, ref_text: str):
+    """Preprocessed reference audio and text, keyed by file mtime so edits invalidate it"""
+    ref_audio, ref_text_processed = preprocess_ref_audio_text(path, ref_text, show_info=lambda *_: None)
+    device = next(ema_model.parameters()).device
+    return load_reference(ref_audio, device), ref_text_processed
+
+
+def preload_voices():
+    """Fill the reference cache for every voice so first requests skip preprocessing"""
+    voices_path = Path(VOICES_DIR)
+    for voice in scan_voices(voices_path)["voices"]:
+        for variation in voice["variations"]:
+            ref_audio_path = voices_path / voice["voice_id"] / f"{variation}.wav"
+            ref_text_path = voices_path / voice["voice_id"] / f"{variation}.txt"
+            try:
+                ref_text = read_text(ref_text_path)
+                _cached_pre(str(ref_audio_path), ref_audio_path.stat().st_mtime, ref_text)
+            except Exception as e:
+                print(f"Warning: could not preload variation '{variation}' of voice '{voice['voice_id']}': {e}")
+
+
+def run_inference(jobs):
+    """Blocking batched generation for queued requests, returning a result or exception per job"""
+    results = [None] * len(jobs)
+    batch = []
+    batch_indices = []
+    for index, (request, ref_audio_path, ref_text) in enumerate(jobs):
+        # A job that cannot be prepared fails alone rather than failing its batch
+        try:
+            # Resolve random seed
+            seed = request.seed
+            if seed < 0 or seed > 2**31 - 1:
+                seed = secrets.randbits(31)
+            
+            # Preprocess reference audio and text (cached until the file changes)
+            mtime = ref_audio_path.stat().st_mtime
+            ref_audio, ref_text_processed = _cached_pre(str(ref_audio_path), mtime, ref_text)
+        except Exception as e:
+            results[index] = e
+            continue
+        
+        batch.append(dict(
+            ref_audio=ref_audio,
+            ref_text=ref_text_processed,
+            gen_text=request.text,
+            speed=request.speed,
+            cross_fade_duration=request.cross_fade_duration,
+            seed=seed,
+        ))
+        batch_indices.append(index)
+    
+    if not batch:
+        return results
+    
+    # Run inference; all jobs in a batch share the same nfe_step.
+    # Autocast's weight-cast cache is disabled because it cannot be used during CUDA graph capture.
+    with torch.inference_mode(), torch.autocast(
+        device_type="cuda", dtype=inference_dtype, enabled=inference_dtype is not None, cache_enabled=False
+    ):
+        outputs = infer_batch(
+            batch,
+            ema_model,
+            vocoder,
+            nfe_step=jobs[0][0].nfe_step,
+            max_batch_size=MAX_BATCH_SIZE,
+            return_spectrogram=False,
+            show_info=print,
+        )
+    
+    # infer_batch returns the exception of a job whose text could not be chunked
+    for index, output in zip(batch_indices, outputs):
+        results[index] = output if isinstance(output, Exception) else output[:2]
+    return results
+
+
+async def next_job(deadline=None):
+    """Next queued job whose client is still waiting, dropping jobs cancelled while queued"""
+    loop = asyncio.get_running_loop()
+    while True:
+        timeout = None if deadline is None else deadline - loop.time()
+        if timeout is not None and timeout <= 0:
+            raise asyncio.TimeoutError
+        job, future = await asyncio.wait_for(inference_queue.get(), timeout=timeout)
+        if not future.cancelled():
+            return job, future
+        inference_queue.task_done()
+
+
+async def next_batch():
+    """Wait for a queued job, then gather more arriving within the batching window"""
+    loop = asyncio.get_running_loop()
+    batch = [await next_job()]
+    deadline = loop.time() + MAX_BATCH_DELAY_MS / 1000
+    
+    while len(batch) < MAX_BATCH_SIZE:
+        try:
+            batch.append(await next_job(deadline))
+        except asyncio.TimeoutError:
+            break
+    
+    return batch
+
+
+async def inference_worker():
+    """Consume queued generation jobs in micro-batches, off the event loop"""
+    while True:
+        batch = await next_batch()
+        
+        # Only jobs sharing a step count can go through the sampler together
+        groups = {}
+        for job, future in batch:
+            groups.setdefault(job[0].nfe_step, []).append((job, future))
+        
+        for group in groups.values():
+            # Skip jobs whose client went away while an earlier group was running
+            group = [(job, future) for job, future in group if not future.cancelled()]
+            if not group:
+                continue
+            try:
+                results = await asyncio.to_thread(run_inference, [job for job, _ in group])
+            except Exception as e:
+                results = [e] * len(group)
+            
+            for (_, future), result in zip(group, results):
+                if future.cancelled():
+                    continue
+                if isinstance(result, Exception):
+                    future.set_exception(result)
+                else:
+                    future.set_result(result)
+        
+        for _ in batch:
+            inference_queue.task_done()
+
+
+async def wait_for_result(future, http_request):
+    """Await a queued job's result, cancelling the job if the client disconnects first"""
+    while not future.done():
+        await asyncio.wait({future}, timeout=DISCONNECT_POLL_INTERVAL)
+        if not future.done() and await http_request.is_disconnected():
+            # The worker drops cancelled jobs instead of running them
+            future.cancel()
+            raise HTTPException(status_code=499, detail="Client closed the request")
+    return future.result()
+
+
+def to_pcm16(wave):
+    """Clip a float waveform to [-1, 1] and scale it to int16, reusing its buffer where possible"""
+    wave = np.clip(wave, -1.0, 1.0, out=wave if wave.dtype == np.float32 else None)
+    wave *= 32767.0
+    return wave.astype(np.int16, copy=False)
+
+
+def pack_sentences(text):
+    """
+    Split text on sentence boundaries and pack the sentences into generation chunks:
+    a first chunk of up to STREAM_FIRST_CHUNK_BYTES, then chunks of up to STREAM_CHUNK_BYTES.
+    A sentence longer than the limit forms its own chunk; chunks under MIN_CHUNK_BYTES
+    are always merged into a neighbour, since the sampler would slow them down.
+    """
+    chunks = []
+    for sentence in SENTENCE_BOUNDARY.split(text.strip()):
+        if not sentence:
+            continue
+        if chunks:
+            limit = STREAM_FIRST_CHUNK_BYTES if len(chunks) == 1 else STREAM_CHUNK_BYTES
+            merged = f"{chunks[-1]} {sentence}"
+            if len(merged.encode("utf-8")) <= limit or len(chunks[-1].encode("utf-8")) < MIN_CHUNK_BYTES:
+                chunks[-1] = merged
+                continue
+        chunks.append(sentence)
+    
+    if len(chunks) > 1 and len(chunks[-1].encode("utf-8")) < MIN_CHUNK_BYTES:
+        last = chunks.pop()
+        chunks[-1] = f"{chunks[-1]} {last}"
+    
+    return chunks
+
+
+def wav_header(sample_rate, channels=1, bits_per_sample=16):
+    """RIFF header for a PCM stream whose total length is not known up front"""
+    # Maximal chunk sizes tell readers to take samples until the end of the stream
+    data_size = 0xFFFFFFFF - 36
+    block_align = channels * bits_per_sample // 8
+    return struct.pack(
+        "<4sI4s4sIHHIIHH4sI",
+        b"RIFF", data_size + 36, b"WAVE",
+        b"fmt ", 16, 1, channels, sample_rate, sample_rate * block_align, block_align, bits_per_sample,
+        b"data", data_size,
+    )
 
 
 # Request/Response models
@@ -58,10 +354,10 @@ class GenerateRequest(BaseModel):
     voice_id: str
     text: str
     variation: Optional[str] = None
-    speed: Optional[float] = 1.0
-    nfe_step: Optional[int] = 32
-    cross_fade_duration: Optional[float] = 0.15
-    seed: Optional[int] = -1
+    speed: float = Field(1.0, gt=0)
+    nfe_step: int = Field(32, gt=0)
+    cross_fade_duration: float = 0.15
+    seed: int = -1
     remove_silence: Optional[bool] = False
 
 
@@ -74,57 +370,54 @@ async def health_check():
     })
 
 
-@app.get("/voices")
-async def list_voices():
-    """List available voices and their variations"""
-    voices = []
-    voices_path = Path(VOICES_DIR)
+def scan_voices(voices_path):
+    """Scan the voices directory in a single pass, reusing the cached payload while unchanged"""
+    try:
+        with os.scandir(voices_path) as it:
+            voice_dirs = [entry for entry in it if entry.is_dir()]
+    except FileNotFoundError:
+        return {"voices": []}
     
-    if not voices_path.exists():
-        return JSONResponse({"voices": []})
+    # Adding or removing a voice or variation file bumps its directory's mtime
+    mtime = (voices_path.stat().st_mtime, tuple((entry.name, entry.stat().st_mtime) for entry in voice_dirs))
+    if mtime == _voices_cache["mtime"]:
+        return _voices_cache["payload"]
     
-    for voice_dir in voices_path.iterdir():
-        if voice_dir.is_dir():
-            voice_id = voice_dir.name
-            variations = []
-            
-            # Find all .wav files in the voice directory
-            for wav_file in voice_dir.glob("*.wav"):
-                variation_name = wav_file.stem
-                # Check if corresponding .txt file exists
-                txt_file = voice_dir / f"{variation_name}.txt"
-                if txt_file.exists():
-                    variations.append(variation_name)
-            
-            if variations:
-                voices.append({
-                    "voice_id": voice_id,
-                    "variations": variations
-                })
+    voices = []
+    for voice_dir in voice_dirs:
+        with os.scandir(voice_dir.path) as it:
+            entries = {entry.name: entry for entry in it if entry.is_file()}
+        
+        # A variation needs both a .wav and a matching .txt file
+        variations = [
+            name[:-4] for name in entries
+            if name.endswith(".wav") and f"{name[:-4]}.txt" in entries
+        ]
+        
+        if variations:
+            voices.append({
+                "voice_id": voice_dir.name,
+                "variations": variations
+            })
     
-    return JSONResponse({"voices": voices})
+    _voices_cache.update(mtime=mtime, payload={"voices": voices})
+    return _voices_cache["payload"]
 
 
-@app.post("/generate")
-async def generate_speech(request: GenerateRequest, background_tasks: BackgroundTasks):
-    """Generate speech using a pre-configured voice"""
-    
-    # Resolve variation (defaults to voice_id if not provided)
-    variation = request.variation or request.voice_id
-    
-    # Build file paths
-    voice_dir = Path(VOICES_DIR) / request.voice_id
+def find_voice_files(voice_id, variation):
+    """Resolve a variation's reference audio and text paths, raising 404 if any are missing"""
+    voice_dir = Path(VOICES_DIR) / voice_id
     ref_audio_path = voice_dir / f"{variation}.wav"
     ref_text_path = voice_dir / f"{variation}.txt"
     
     # Validate files exist
     if not voice_dir.exists():
-        raise HTTPException(status_code=404, detail=f"Voice ID '{request.voice_id}' not found")
+        raise HTTPException(status_code=404, detail=f"Voice ID '{voice_id}' not found")
     
     if not ref_audio_path.exists():
         raise HTTPException(
             status_code=404, 
-            detail=f"Variation '{variation}' not found for voice '{request.voice_id}'"
+            detail=f"Variation '{variation}' not found for voice '{voice_id}'"
         )
     
     if not ref_text_path.exists():
@@ -133,61 +426,99 @@ async def generate_speech(request: GenerateRequest, background_tasks: Background
             detail=f"Reference text file not found for variation '{variation}'"
         )
     
+    return ref_audio_path, ref_text_path
+
+
+def read_text(path):
+    """Read a reference transcript, stripped of surrounding whitespace"""
+    with open(path, 'r', encoding='utf-8') as f:
+        return f.read().strip()
+
+
+@app.get("/voices")
+async def list_voices():
+    """List available voices and their variations"""
+    # A missing voices directory lists as empty
+    return JSONResponse(await asyncio.to_thread(scan_voices, Path(VOICES_DIR)))
+
+
+@app.post("/generate")
+async def generate_speech(request: GenerateRequest, http_request: Request):
+    """Generate speech using a pre-configured voice"""
+    
+    # Resolve variation (defaults to voice_id if not provided)
+    variation = request.variation or request.voice_id
+    
+    # Check the voice files off the event loop, which may sit on slow or network storage
+    ref_audio_path, ref_text_path = await asyncio.to_thread(find_voice_files, request.voice_id, variation)
+    
     # Validate text parameter
     if not request.text or not request.text.strip():
         raise HTTPException(status_code=400, detail="Text parameter is required and cannot be empty")
     
     # Read reference text
-    with open(ref_text_path, 'r', encoding='utf-8') as f:
-        ref_text = f.read().strip()
+    ref_text = await asyncio.to_thread(read_text, ref_text_path)
+    
+    # Long text is generated chunk by chunk and streamed as each chunk finishes
+    chunks = pack_sentences(request.text)
+    loop = asyncio.get_running_loop()
+    
+    async def submit(index):
+        """Queue a text chunk for the inference worker"""
+        future = loop.create_future()
+        job = (request.model_copy(update={"text": chunks[index]}), ref_audio_path, ref_text)
+        await inference_queue.put((job, future))
+        return future
     
+    # Reject the request if the queue is full; later chunks wait for room instead
+    if inference_queue.full():
+        raise HTTPException(status_code=503, detail="Server is busy, please retry later")
+    
+    # Wait for the first chunk before responding so its failures still map to a 500
     try:
-        # Set random seed
-        seed = request.seed
-        if seed < 0 or seed > 2**31 - 1:
-            seed = np.random.randint(0, 2**31 - 1)
-        torch.manual_seed(seed)
-        
-        # Preprocess reference audio and text
-        ref_audio, ref_text_processed = preprocess_ref_audio_text(
-            str(ref_audio_path), 
-            ref_text,
-            show_info=print
-        )
-        
-        # Run inference
-        final_wave, final_sample_rate, combined_spectrogram = infer_process(
-            ref_audio,
-            ref_text_processed,
-            request.text,
-            ema_model,
-            vocoder,
-            cross_fade_duration=request.cross_fade_duration,
-            nfe_step=request.nfe_step,
-            speed=request.speed,
-            show_info=print,
-        )
-        
-        # Save to temporary file
-        with tempfile.NamedTemporaryFile(suffix=".wav", delete=False) as tmp_file:
-            output_path = tmp_file.name
-            sf.write(output_path, final_wave, final_sample_rate)
-
-        # Schedule cleanup after response is sent
-        background_tasks.add_task(os.unlink, output_path)
-
-        # Return audio file
-        return FileResponse(
-            output_path,
-            media_type="audio/wav",
-            filename=f"{request.voice_id}_{variation}.wav"
-        )
-        
+        first_wave, sample_rate = await wait_for_result(await submit(0), http_request)
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Model inference error: {str(e)}")
+    
+    cross_fade_samples = max(int(request.cross_fade_duration * sample_rate), 0)
+    
+    async def stream_wav():
+        """Yield the WAV header, then 16-bit PCM for each chunk as it is generated"""
+        wave, tail = first_wave, None
+        pending = deque()
+        next_index = 1
+        try:
+            yield wav_header(sample_rate)
+            while wave is not None:
+                # Keep up to a batch of chunks queued so they are sampled together
+                while next_index < len(chunks) and len(pending) < MAX_BATCH_SIZE:
+                    pending.append(await submit(next_index))
+                    next_index += 1
+                
+                # Hold back the end of each chunk to cross-fade it into the next one
+                if tail is not None:
+                    wave = cross_fade([tail, wave], request.cross_fade_duration)
+                split = max(len(wave) - cross_fade_samples, 0) if pending else len(wave)
+                tail = wave[split:]
+                if split:
+                    yield to_pcm16(wave[:split]).tobytes()
+                
+                wave = (await pending.popleft())[0] if pending else None
+        finally:
+            for future in pending:
+                future.cancel()
+    
+    return StreamingResponse(
+        stream_wav(),
+        media_type="audio/wav",
+        headers={"Content-Disposition": f'attachment; filename="{request.voice_id}_{variation}.wav"'}
+    )
 
 
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run(app, host=HOST, port=PORT)
+    # One worker: each worker process would load its own copy of the models.
+    uvicorn.run(app, host=HOST, port=PORT, loop="uvloop", http="httptools", workers=1)
 
@@ -0,0 +1,512 @@
+"""
+Sampling loop for the F5-TTS DiT used by the server.
+
+A copy of ``utils_infer.infer_process`` and ``CFM.sample`` from f5-tts 1.1.22,
+kept in-tree so the server owns the denoising loop. As upstream, the conditional
+and unconditional guidance passes of every step run as one packed DiT forward;
+on top of that, text chunks from several concurrent requests can share one
+padded batch.
+"""
+
+from collections import OrderedDict
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+import torchaudio
+from torch.nn.utils.rnn import pad_sequence
+
+from f5_tts.infer.utils_infer import (
+    chunk_text,
+    hop_length,
+    target_sample_rate,
+)
+from f5_tts.model.utils import convert_char_to_pinyin, get_epss_timesteps, lens_to_mask, list_str_to_idx
+
+# Longest generation window in seconds, reference audio included, that text chunks are sized to
+MAX_WINDOW_SECONDS = 22
+
+# Text chunks shorter than this many bytes are generated at a slowed-down speaking rate
+MIN_CHUNK_BYTES = 10
+
+
+def _dit_forward(transformer, x, cond, text_embed, time, mask=None):
+    """Run the DiT blocks on already-embedded text, skipping its per-call text cache"""
+    batch, seq_len = x.shape[0], x.shape[1]
+    if time.ndim == 0:
+        time = time.repeat(batch)
+
+    t = transformer.time_embed(time)
+    x = transformer.input_embed(x, cond, text_embed, audio_mask=mask)
+    rope = transformer.rotary_embed.forward_from_seq_len(seq_len)
+
+    if transformer.long_skip_connection is not None:
+        residual = x
+
+    for block in transformer.transformer_blocks:
+        x = block(x, t, mask=mask, rope=rope)
+
+    if transformer.long_skip_connection is not None:
+        x = transformer.long_skip_connection(torch.cat((x, residual), dim=-1))
+
+    x = transformer.norm_out(x, t)
+    return transformer.proj_out(x)
+
+
+def _guided_step(transformer, x, cond, text_embed, time, mask, cfg_strength):
+    """Predicted flow for one denoising step, with classifier-free guidance when enabled"""
+    if cfg_strength < 1e-5:
+        return _dit_forward(transformer, x, cond, text_embed, time, mask)
+
+    pred_cfg = _dit_forward(transformer, torch.cat((x, x), dim=0), cond, text_embed, time, mask)
+    pred, null_pred = pred_cfg.chunk(2, dim=0)
+    return pred + (pred - null_pred) * cfg_strength
+
+
+class CUDAGraphRunner:
+    """
+    Captures the guided DiT step as a CUDA graph per input shape and replays it.
+
+    Step-invariant inputs are copied into the graph's static buffers once per
+    :meth:`bind`, the noisy input and time once per step. At most ``max_graphs``
+    graphs are kept, evicting the least recently used.
+    """
+
+    def __init__(self, max_graphs=8, warmup_iters=3):
+        self.max_graphs = max_graphs
+        self.warmup_iters = warmup_iters
+        self.graphs = OrderedDict()
+        self.pool = torch.cuda.graph_pool_handle()
+
+    def bind(self, transformer, cond, text_embed, mask, x_shape, cfg_strength):
+        key = (
+            id(transformer),
+            tuple(x_shape),
+            tuple(cond.shape),
+            tuple(text_embed.shape),
+            None if mask is None else tuple(mask.shape),
+            cond.dtype,
+            cfg_strength,
+        )
+        if key in self.graphs:
+            self.graphs.move_to_end(key)
+        else:
+            self.graphs[key] = self._capture(transformer, cond, text_embed, mask, x_shape, cfg_strength)
+            if len(self.graphs) > self.max_graphs:
+                self.graphs.popitem(last=False)
+
+        graph, inputs, output = self.graphs[key]
+        inputs["cond"].copy_(cond)
+        inputs["text_embed"].copy_(text_embed)
+        if mask is not None:
+            inputs["mask"].copy_(mask)
+
+        def step(x, time):
+            inputs["x"].copy_(x)
+            inputs["time"].copy_(time)
+            graph.replay()
+            return output
+
+        return step
+
+    def _capture(self, transformer, cond, text_embed, mask, x_shape, cfg_strength):
+        inputs = {
+            "x": torch.zeros(x_shape, device=cond.device, dtype=cond.dtype),
+            "cond": cond.clone(),
+            "text_embed": text_embed.clone(),
+            "mask": None if mask is None else mask.clone(),
+            "time": torch.zeros((), device=cond.device, dtype=cond.dtype),
+        }
+
+        def run():
+            return _guided_step(
+                transformer, inputs["x"], inputs["cond"], inputs["text_embed"], inputs["time"], inputs["mask"], cfg_strength
+            )
+
+        # Warm up on a side stream so lazy initialization and compilation happen outside capture
+        stream = torch.cuda.Stream(device=cond.device)
+        stream.wait_stream(torch.cuda.current_stream(cond.device))
+        with torch.cuda.stream(stream):
+            for _ in range(self.warmup_iters):
+                run()
+        torch.cuda.current_stream(cond.device).wait_stream(stream)
+
+        graph = torch.cuda.CUDAGraph()
+        with torch.cuda.graph(graph, pool=self.pool, capture_error_mode="thread_local"):
+            output = run()
+
+        return graph, inputs, output
+
+
+_graph_runner = None
+_bucket_size = None
+_streams = None
+
+
+def compile_dit(**compile_kwargs):
+    """Replace the per-step DiT forward with a ``torch.compile``d version"""
+    global _dit_forward
+    _dit_forward = torch.compile(_dit_forward, **compile_kwargs)
+
+
+def enable_cuda_graphs(max_graphs=8):
+    """Replay the denoising step from captured CUDA graphs instead of launching kernels from Python"""
+    global _graph_runner
+    _graph_runner = CUDAGraphRunner(max_graphs=max_graphs)
+
+
+def graph_cache_size(max_batch_size, bucket_size, default=8):
+    """
+    Number of distinct bucketed step shapes sampling can produce, one per batch size
+    from 2 to ``max_batch_size`` and length bucket, so that a CUDA graph can be kept
+    for each. Without buckets lengths are unbounded and ``default`` is returned.
+    """
+    if not bucket_size:
+        return default
+    max_frames = MAX_WINDOW_SECONDS * target_sample_rate // hop_length
+    return max(max_batch_size - 1, 1) * -(-max_frames // bucket_size)
+
+
+def enable_stream_overlap():
+    """Run the DiT and the vocoder on separate CUDA streams so consecutive batches can overlap"""
+    global _streams
+    _streams = (torch.cuda.Stream(), torch.cuda.Stream())
+
+
+def enable_shape_buckets(model, bucket_size=64):
+    """
+    Pad batches up to a multiple of ``bucket_size`` frames so that compiled
+    kernels and CUDA graphs are shared by requests of similar length.
+
+    Batches are padded and masked anyway, so rounding them up only adds masked
+    frames. Single rows are left unpadded: padding them would force a boolean
+    attention mask, which SDPA materializes per head and which rules out its
+    flash kernel. They run without CUDA graphs instead, since their exact
+    lengths rarely repeat.
+    """
+    global _bucket_size
+    _bucket_size = bucket_size
+
+
+def _bind_step(transformer, cond, text_embed, mask, x_shape, cfg_strength, use_graph=True):
+    """Guided step function of ``(x, time)`` with the step-invariant inputs fixed"""
+    if use_graph and _graph_runner is not None and cond.is_cuda:
+        return _graph_runner.bind(transformer, cond, text_embed, mask, x_shape, cfg_strength)
+
+    return lambda x, time: _guided_step(transformer, x, cond, text_embed, time, mask, cfg_strength)
+
+
+def _enable_attention_masks(transformer):
+    """Make the DiT's attention honour the padding mask; it is ignored unless switched on"""
+    for block in transformer.transformer_blocks:
+        block.attn.processor.attn_mask_enabled = True
+
+
+@torch.inference_mode()
+def sample(model, cond, text, duration, steps=32, cfg_strength=2.0, sway_sampling_coef=-1.0, seeds=None):
+    """
+    Batched Euler flow-matching sampler with cond/uncond packed into one forward per step.
+
+    ``cond`` holds one reference waveform per row, ``text`` the matching token lists and
+    ``duration`` the requested frame counts. Rows are padded to the longest duration
+    (rounded up to the shape bucket for batches, if enabled); returns the mel batch
+    together with the per-row durations actually used.
+    """
+    transformer = model.transformer
+    dtype = next(model.parameters()).dtype
+    device = cond[0].device
+    batch = len(cond)
+
+    # Reference audio -> mel condition, padded across the batch
+    cond = [model.mel_spec(wave).permute(0, 2, 1)[0].to(dtype) for wave in cond]
+    lens = torch.tensor([mel.shape[0] for mel in cond], device=device, dtype=torch.long)
+
+    text = list_str_to_idx(text, model.vocab_char_map).to(device)
+    duration = torch.tensor(duration, device=device, dtype=torch.long)
+    duration = torch.maximum(torch.maximum((text != -1).sum(dim=-1), lens) + 1, duration)
+    max_duration = int(duration.amax())
+    padded_len = max_duration
+    if _bucket_size and batch > 1:
+        padded_len = -(-max_duration // _bucket_size) * _bucket_size
+
+    cond = pad_sequence(cond, padding_value=0.0, batch_first=True)
+    cond = F.pad(cond, (0, 0, 0, padded_len - cond.shape[1]), value=0.0)
+    cond_mask = lens_to_mask(lens, length=padded_len).unsqueeze(-1)
+
+    # A single unpadded row needs no mask, matching CFM.sample
+    if batch > 1:
+        mask = lens_to_mask(duration, length=padded_len)
+        seq_len = duration
+        _enable_attention_masks(transformer)
+    else:
+        mask = None
+        seq_len = max_duration
+
+    # Text embeddings do not change across steps, so compute both branches once
+    def embed_text(drop_text):
+        text_embed = transformer.text_embed(text, seq_len, drop_text=drop_text)
+        return F.pad(text_embed, (0, 0, 0, padded_len - text_embed.shape[1]), value=0.0)
+
+    text_cond = embed_text(drop_text=False)
+    if cfg_strength < 1e-5:
+        step_cond, step_text, step_mask = cond, text_cond, mask
+    else:
+        text_uncond = embed_text(drop_text=True)
+        step_cond = torch.cat((cond, torch.zeros_like(cond)), dim=0)
+        step_text = torch.cat((text_cond, text_uncond), dim=0)
+        step_mask = torch.cat((mask, mask), dim=0) if mask is not None else None
+
+    t = get_epss_timesteps(steps, device=device, dtype=dtype)
+    if sway_sampling_coef is not None:
+        t = t + sway_sampling_coef * (torch.cos(torch.pi / 2 * t) - 1 + t)
+
+    # Noise is drawn per row from its own generator, so a request's output depends neither
+    # on its batch mates nor on global RNG state shared with other threads
+    durations = duration.tolist()
+    y0 = []
+    for i, dur in enumerate(durations):
+        generator = None
+        if seeds is not None and seeds[i] is not None:
+            generator = torch.Generator(device=device)
+            generator.manual_seed(seeds[i])
+        y0.append(torch.randn(dur, model.num_channels, device=device, dtype=dtype, generator=generator))
+    x = pad_sequence(y0, padding_value=0.0, batch_first=True)
+    x = F.pad(x, (0, 0, 0, padded_len - max_duration), value=0.0)
+
+    # With buckets on, only bucketed batch shapes repeat often enough to be worth a graph
+    use_graph = not _bucket_size or batch > 1
+    step = _bind_step(transformer, step_cond, step_text, step_mask, x.shape, cfg_strength, use_graph)
+    for t0, t1 in zip(t[:-1], t[1:]):
+        x = x + (t1 - t0) * step(x, t0)
+
+    return torch.where(cond_mask, cond, x), durations
+
+
+def cross_fade(waves, cross_fade_duration):
+    """Concatenate generated chunks, linearly cross-fading the overlaps"""
+    final_wave = waves[0]
+    cross_fade_samples = int(cross_fade_duration * target_sample_rate)
+
+    for next_wave in waves[1:]:
+        overlap = min(cross_fade_samples, len(final_wave), len(next_wave))
+        if overlap <= 0:
+            final_wave = np.concatenate([final_wave, next_wave])
+            continue
+
+        fade_out = np.linspace(1, 0, overlap)
+        fade_in = np.linspace(0, 1, overlap)
+        cross_faded = final_wave[-overlap:] * fade_out + next_wave[:overlap] * fade_in
+        final_wave = np.concatenate([final_wave[:-overlap], cross_faded, next_wave[overlap:]])
+
+    return final_wave
+
+
+def load_reference(ref_audio, device, target_rms=0.1):
+    """Load a reference clip as a mono, loudness-normalized, resampled tensor on ``device``"""
+    audio, sr = torchaudio.load(ref_audio)
+    seconds = audio.shape[-1] / sr
+
+    if audio.shape[0] > 1:
+        audio = torch.mean(audio, dim=0, keepdim=True)
+    rms = torch.sqrt(torch.mean(torch.square(audio)))
+    if rms < target_rms:
+        audio = audio * target_rms / rms
+    if sr != target_sample_rate:
+        audio = torchaudio.transforms.Resample(sr, target_sample_rate)(audio)
+
+    return {"audio": audio.to(device, non_blocking=True), "rms": rms, "seconds": seconds}
+
+
+def _prepare_job(job, device, target_rms):
+    """Split a job's text into per-row generation chunks against its reference audio"""
+    speed = job.get("speed", 1.0)
+    ref_text = job["ref_text"]
+
+    # Accept either a path or a reference already prepared by load_reference
+    reference = job["ref_audio"]
+    if not isinstance(reference, dict):
+        reference = load_reference(reference, device, target_rms)
+    audio, rms, seconds = reference["audio"], reference["rms"], reference["seconds"]
+
+    max_chars = int(len(ref_text.encode("utf-8")) / seconds * (MAX_WINDOW_SECONDS - seconds) * speed)
+    gen_text_batches = chunk_text(job["gen_text"], max_chars=max_chars)
+
+    if len(ref_text[-1].encode("utf-8")) == 1:
+        ref_text = ref_text + " "
+
+    ref_audio_len = audio.shape[-1] // hop_length
+    ref_text_len = len(ref_text.encode("utf-8"))
+
+    rows = []
+    for text_batch in gen_text_batches:
+        gen_text_len = len(text_batch.encode("utf-8"))
+        local_speed = 0.3 if gen_text_len < MIN_CHUNK_BYTES else speed
+        rows.append({
+            "audio": audio,
+            "rms": rms,
+            "text": convert_char_to_pinyin([ref_text + text_batch])[0],
+            "ref_audio_len": ref_audio_len,
+            "duration": ref_audio_len + int(ref_audio_len / ref_text_len * gen_text_len / local_speed),
+            "seed": job.get("seed"),
+        })
+    return rows
+
+
+def _decode(vocoder, group, generated, durations, target_rms):
+    """Vocode each row's generated frames, returning ``(wave, mel)`` device tensors per row"""
+    decoded = []
+
+    # The vocoder is kept in FP32 even when the DiT runs under autocast
+    with torch.inference_mode(), torch.autocast(device_type=generated.device.type, enabled=False):
+        for row, mel, duration in zip(group, generated, durations):
+            mel = mel[row["ref_audio_len"]:duration].to(torch.float32).T.unsqueeze(0)
+            wave = vocoder.decode(mel)
+            if row["rms"] < target_rms:
+                wave = wave * row["rms"] / target_rms
+            decoded.append((wave, mel))
+
+    return decoded
+
+
+def _collect(group, decoded, generated, vocoder_stream, return_spectrogram):
+    """Copy a group's decoded rows to host memory, waiting for the vocoder stream"""
+    # ``generated`` is only held so its memory is not reused before the vocoder has read it
+    with torch.cuda.stream(vocoder_stream):
+        for row, (wave, mel) in zip(group, decoded):
+            row["wave"] = wave.squeeze().cpu().numpy()
+            if return_spectrogram:
+                row["mel"] = mel[0].cpu().numpy()
+
+
+def infer_batch(
+    jobs,
+    model_obj,
+    vocoder,
+    show_info=print,
+    target_rms=0.1,
+    nfe_step=32,
+    cfg_strength=2.0,
+    sway_sampling_coef=-1.0,
+    max_batch_size=4,
+    return_spectrogram=True,
+):
+    """
+    Generate several jobs together, batching their text chunks through the DiT.
+
+    Each job is a dict with ``ref_audio`` (a path or a :func:`load_reference` result),
+    ``ref_text`` and ``gen_text``, plus optional ``speed``, ``cross_fade_duration`` and
+    ``seed``. Returns one ``(final_wave, sample_rate, combined_spectrogram)`` tuple per
+    job, in order; the spectrogram is ``None`` unless ``return_spectrogram`` is set. A job
+    that cannot be prepared gets its exception in place of a tuple, without failing the rest.
+    """
+    device = next(model_obj.parameters()).device
+
+    results = [None] * len(jobs)
+    rows = []
+    for job_index, job in enumerate(jobs):
+        try:
+            job_rows = _prepare_job(job, device, target_rms)
+        except Exception as e:
+            results[job_index] = e
+            continue
+        for chunk_index, row in enumerate(job_rows):
+            rows.append(dict(row, job=job_index, chunk=chunk_index))
+
+    show_info(f"Generating {len(rows)} chunks for {len(jobs)} requests...")
+
+    # Group rows of similar length so each DiT batch carries little padding
+    rows.sort(key=lambda row: row["duration"])
+    for row in rows:
+        row["wave"] = row["mel"] = None
+
+    dit_stream, vocoder_stream = _streams if _streams is not None and device.type == "cuda" else (None, None)
+    if dit_stream is not None:
+        dit_stream.wait_stream(torch.cuda.current_stream(device))
+
+    # Each group's vocoder work is queued before the previous group's results are
+    # collected, so it can run on its own stream while the next DiT group is launched
+    pending = None
+    for start in range(0, len(rows), max_batch_size):
+        group = rows[start:start + max_batch_size]
+        with torch.cuda.stream(dit_stream):
+            generated, durations = sample(
+                model_obj,
+                [row["audio"] for row in group],
+                [row["text"] for row in group],
+                [row["duration"] for row in group],
+                steps=nfe_step,
+                cfg_strength=cfg_strength,
+                sway_sampling_coef=sway_sampling_coef,
+                seeds=[row["seed"] for row in group],
+            )
+
+        with torch.cuda.stream(vocoder_stream):
+            if vocoder_stream is not None:
+                vocoder_stream.wait_stream(dit_stream)
+            decoded = _decode(vocoder, group, generated, durations, target_rms)
+
+        if pending is not None:
+            _collect(*pending, vocoder_stream, return_spectrogram)
+        pending = (group, decoded, generated)
+
+    if pending is not None:
+        _collect(*pending, vocoder_stream, return_spectrogram)
+
+    for job_index, job in enumerate(jobs):
+        if results[job_index] is not None:
+            continue
+        job_rows = sorted((row for row in rows if row["job"] == job_index), key=lambda row: row["chunk"])
+        if not job_rows:
+            results[job_index] = (None, target_sample_rate, None)
+            continue
+
+        waves = [row["wave"] for row in job_rows]
+        cross_fade_duration = job.get("cross_fade_duration", 0.15)
+        if cross_fade_duration <= 0:
+            final_wave = np.concatenate(waves)
+        else:
+            final_wave = cross_fade(waves, cross_fade_duration)
+
+        combined_spectrogram = None
+        if return_spectrogram:
+            combined_spectrogram = np.concatenate([row["mel"] for row in job_rows], axis=1)
+        results[job_index] = (final_wave, target_sample_rate, combined_spectrogram)
+
+    return results
+
+
+def infer_process(
+    ref_audio,
+    ref_text,
+    gen_text,
+    model_obj,
+    vocoder,
+    show_info=print,
+    target_rms=0.1,
+    cross_fade_duration=0.15,
+    nfe_step=32,
+    cfg_strength=2.0,
+    sway_sampling_coef=-1.0,
+    speed=1.0,
+):
+    """Drop-in replacement for ``utils_infer.infer_process``, a single-job :func:`infer_batch`"""
+    job = dict(
+        ref_audio=ref_audio,
+        ref_text=ref_text,
+        gen_text=gen_text,
+        speed=speed,
+        cross_fade_duration=cross_fade_duration,
+    )
+    result = infer_batch(
+        [job],
+        model_obj,
+        vocoder,
+        show_info=show_info,
+        target_rms=target_rms,
+        nfe_step=nfe_step,
+        cfg_strength=cfg_strength,
+        sway_sampling_coef=sway_sampling_coef,
+    )[0]
+    if isinstance(result, Exception):
+        raise result
+    return result
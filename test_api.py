@@ -4,16 +4,22 @@ Test script for byov-tts-server
 Assumes the server is running on localhost:7861
 """
 
+import io
 import json
 import os
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
 import requests
+import soundfile as sf
 
 # Configuration
 # Server must be running already!
 API_BASE_URL = "http://localhost:7861"
 TEST_DATA_DIR = Path("test_data/test_api")
+# Must match the server's settings; used to size the queue-full test
+INFERENCE_QUEUE_SIZE = int(os.getenv("INFERENCE_QUEUE_SIZE", "8"))
+MAX_BATCH_SIZE = int(os.getenv("MAX_BATCH_SIZE", "4"))
 
 
 def setup_test_directories():
@@ -283,6 +289,100 @@ def test_generate_narrative():
         return False
 
 
+def test_generate_streamed_sentences():
+    """Test the streamed WAV for multi-sentence text that includes short sentences"""
+    print("\n" + "="*60)
+    print("TEST: Streamed Multi-Sentence Generation")
+    print("="*60)
+    
+    request_data = {
+        "voice_id": "test_voice",
+        "variation": "variation",
+        "text": "Hello. How are you? Fine. The evening was quiet, and the streets "
+                "were almost empty. A single lamp flickered at the corner! Was anyone "
+                "still awake at this hour? Nobody answered. The wind picked up and "
+                "carried the sound of distant bells across the rooftops."
+    }
+    
+    print(f"Text length: {len(request_data['text'])} characters")
+    
+    try:
+        response = requests.post(
+            f"{API_BASE_URL}/generate",
+            json=request_data,
+            stream=True
+        )
+        response.raise_for_status()
+        content = response.content
+        
+        output_file = TEST_DATA_DIR / "streamed_sentences.wav"
+        with open(output_file, "wb") as f:
+            f.write(content)
+        
+        # The streamed header declares an unknown length, so decode up to the end of the body
+        audio, sample_rate = sf.read(io.BytesIO(content), dtype="int16")
+        print(f"Status Code: {response.status_code}")
+        print(f"Content-Type: {response.headers.get('content-type')}")
+        print(f"Audio saved to: {output_file}")
+        print(f"Decoded: {len(audio):,} samples at {sample_rate} Hz ({len(audio) / sample_rate:.2f}s)")
+        
+        assert response.headers.get("content-type") == "audio/wav", "Unexpected content type"
+        assert sample_rate == 24000, f"Unexpected sample rate: {sample_rate}"
+        assert len(audio) > 0, "Decoded audio is empty"
+        assert len(content) - 44 == len(audio) * 2, "Streamed body does not match the decoded samples"
+        print("✓ Streamed multi-sentence generation passed")
+        return True
+    except Exception as e:
+        print(f"✗ Streamed multi-sentence generation failed: {e}")
+        if hasattr(e, 'response') and e.response is not None:
+            print(f"Error response: {e.response.text}")
+        return False
+
+
+def test_error_queue_full():
+    """Test that requests beyond the inference queue are rejected with 503"""
+    print("\n" + "="*60)
+    print("TEST: Error Handling - Queue Full")
+    print("="*60)
+    
+    request_data = {
+        "voice_id": "test_voice",
+        "variation": "variation",
+        "text": "This request is one of many sent at the same time."
+    }
+    
+    # Twice what the server can hold at once (queued plus in the running batch)
+    concurrent_requests = 2 * (INFERENCE_QUEUE_SIZE + MAX_BATCH_SIZE)
+    print(f"Sending {concurrent_requests} concurrent requests")
+    
+    def send(_):
+        response = requests.post(f"{API_BASE_URL}/generate", json=request_data)
+        return response.status_code, response.content
+    
+    try:
+        with ThreadPoolExecutor(max_workers=concurrent_requests) as executor:
+            results = list(executor.map(send, range(concurrent_requests)))
+        
+        status_codes = [status_code for status_code, _ in results]
+        print(f"Status Codes: {status_codes}")
+        
+        for status_code, content in results:
+            assert status_code in (200, 503), f"Unexpected status code: {status_code}"
+            if status_code == 503:
+                error_data = json.loads(content)
+                assert "detail" in error_data, "503 response has no detail"
+            else:
+                assert len(content) > 44, "Generated audio is empty"
+        
+        rejected = status_codes.count(503)
+        assert rejected > 0, "No request was rejected with 503"
+        print(f"✓ Queue full handling passed ({rejected} request(s) rejected with 503)")
+        return True
+    except Exception as e:
+        print(f"✗ Queue full test failed: {e}")
+        return False
+
+
 def test_error_invalid_voice():
     """Test error handling for invalid voice_id"""
     print("\n" + "="*60)
@@ -373,8 +473,10 @@ def main():
         "Speed Variations": test_generate_with_speed(),
         "Long Text Generation": test_generate_long_text(),
         "Narrative Text": test_generate_narrative(),
+        "Streamed Sentences": test_generate_streamed_sentences(),
         "Error - Invalid Voice": test_error_invalid_voice(),
         "Error - Empty Text": test_error_empty_text(),
+        "Error - Queue Full": test_error_queue_full(),
     }
     
     # Summary